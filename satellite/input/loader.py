@@ -21,15 +21,11 @@ class Loader:
         :param directory: 
         :return input_img_paths: list
         """
-        input_img_paths = sorted(
-            [
-                os.path.join(directory, fname)
-                for fname in os.listdir(directory)
-                if (fname.endswith(settings.GEOGRAPHIC_ACCEPT_EXTENSION)
-                    or fname.endswith(settings.NON_GEOGRAPHIC_ACCEPT_EXTENSION))
-                   and not fname.startswith(".")
-            ]
-        )
+        accept_extension = settings.GEOGRAPHIC_ACCEPT_EXTENSION + settings.NON_GEOGRAPHIC_ACCEPT_EXTENSION
+        with os.scandir(directory) as entries:
+            input_img_paths = [entry.path for entry in entries
+                               if entry.name.endswith(accept_extension) and not entry.name.startswith(".")]
+        input_img_paths.sort()
 
         logging.info(">>>> Number of samples: {}".format(len(input_img_paths)))
         return input_img_paths
@@ -0,0 +1,28 @@
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def palette_lookup_numba(classes_map, palette, out):
+    """
+    Draw the class of each pixel with its palette color, in a single sweep over the classes map. The palette
+    already holds the alpha of each class, so no per-pixel color test is needed to make the background transparent
+
+    :param classes_map: uint8 array with the index of the class of each pixel, with shape (height, width)
+    :param palette: uint8 array with the color of each class and its alpha in the last channel, with
+                    shape (classes, 4). The channels are copied in the same order to out
+    :param out: pre-allocated uint8 array, with shape (height, width, 4), where the result is written
+    """
+    H, W = classes_map.shape
+    for i in prange(H):
+        for j in range(W):
+            best = classes_map[i, j]
+            out[i, j, 0] = palette[best, 0]
+            out[i, j, 1] = palette[best, 1]
+            out[i, j, 2] = palette[best, 2]
+            out[i, j, 3] = palette[best, 3]
+
+
+try:
+    from satellite.output.segment_kernel import palette_lookup
+except ImportError:
+    palette_lookup = palette_lookup_numba
@@ -1,58 +1,97 @@
 import os
 import logging
-import imageio
+import threading
+import multiprocessing
 import cv2
 import gdal
 import numpy as np
 import satellite.input.loader as loader
 import satellite.output.slicer as slicer
 import satellite.output.poligonize as poligonizer
+import satellite.output._kernels as _kernels
 from satellite import settings
 
 from utils import utils
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.preprocessing.image import load_img
+from PIL import Image
+from numba import set_num_threads
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+gdal.SetConfigOption('GTIFF_USE_DEFER_STRILE_LOADING', 'YES')
+
+_PALETTE_CACHE = {}
+_OUTPUT_BUFFERS = {}
+
+
+def _get_palette(classes, img_channels):
+    """
+    Build the BGRA palette of the classes once, and keep it cached for the next segmentations. The colors are
+    stored in the channel order OpenCV writes, so the segmentation does not need to be converted. The cache is
+    keyed by the classes's contents, since the parameters reach the process pool as a new copy on each call
+
+    :param classes: dict with the index of each class and its respective color
+    :param img_channels: the number of channels of each color
+    :return palette: uint8 array with the BGRA color of each class, with shape (classes, img_channels + 1)
+    """
+    key = (img_channels, tuple(sorted((idx, tuple(color)) for idx, color in classes.items())))
+    palette = _PALETTE_CACHE.get(key)
+    if palette is None:
+        palette = np.zeros((max(classes) + 1, img_channels + 1), dtype=np.uint8)
+        for idx, color in classes.items():
+            palette[idx, :img_channels] = color[::-1]
+        palette[:, img_channels] = np.where(np.bitwise_or.reduce(palette[:, :img_channels], axis=-1) == 0, 0, 255)
+        _PALETTE_CACHE[key] = palette
+    return palette
+
+
+def _segment_one(args):
+    """
+    Module level implementation of Infer.segment_image, so it can be dispatched to a process pool
+
+    :param args: tuple (image_path, prediction, network_params), as in Infer.segment_image
+    :return prediction_path: absolute path to the local prediction file
+    """
+    image_path, prediction, network_params = args
+
+    output_path = network_params['tmp_slices_predictions']
+    img_width = network_params['input_size_w']
+    img_height = network_params['input_size_h']
+    img_channels = network_params['input_size_c']
+
+    palette = _get_palette(network_params['color_classes'], img_channels)
+    prediction = np.ascontiguousarray(np.reshape(prediction, (img_height, img_width)), dtype=np.uint8)
+
+    shape = (img_height, img_width, img_channels + 1)
+    img_color = _OUTPUT_BUFFERS.get(shape)
+    if img_color is None:
+        img_color = _OUTPUT_BUFFERS[shape] = np.empty(shape, dtype=np.uint8)
+    _kernels.palette_lookup(prediction, palette, img_color)
+
+    filename = os.path.basename(image_path)
+    name, file_extension = os.path.splitext(filename)
+    prediction_path = os.path.join(output_path, name + '.png')
+    cv2.imwrite(prediction_path, img_color, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return prediction_path
 
 
 class Infer:
     def __init__(self):
-        pass
+        self._gdal_cache = {}
+        self._poligonize_lock = threading.Lock()
 
     def segment_image(self, image_path, prediction, network_params):
         """
         Create a new RGB image, drawing the predictions based on classes's colors
 
         :param image_path: absolute path to original image to be segmented
-        :param prediction: the array with the probabilities to each class representing each pixel
+        :param prediction: the array with the index of the class of each pixel
         :param network_params: the deep learning architecture parameters
         :return prediction_path: absolute path to the local prediction file
         """
-        classes = network_params['color_classes']
-        output_path = network_params['tmp_slices_predictions']
-        img_width = network_params['input_size_w']
-        img_height = network_params['input_size_h']
-        img_channels = network_params['input_size_c']
-
-        output = np.argmax(prediction, axis=-1)
-        output = np.reshape(output, (img_width, img_height))
+        return _segment_one((image_path, prediction, network_params))
 
-        img_color = np.zeros((img_width, img_height, img_channels + 1), dtype='uint8')
-        img_color[:, :, img_channels] = 255
-        for i in range(img_width):
-            for j in range(img_height):
-                idx = output[i, j]
-                img_color[i, j, 0:img_channels] = classes[idx]
-
-        m_black = (img_color[:, :, 0:img_channels] == [0, 0, 0]).all(2)
-        img_color[m_black] = (0, 0, 0, 0)
-
-        filename = os.path.basename(image_path)
-        name, file_extension = os.path.splitext(filename)
-        prediction_path = os.path.join(output_path, name + '.png')
-        imageio.imwrite(prediction_path, img_color)
-        return prediction_path
-
-    def poligonize(self, segmented_image_path, classes, original_images_path, output_vector_path):
+    def poligonize(self, segmented_image_path, classes, original_images_path, output_vector_path,
+                   original_image=None):
         """
         Turn a JPG, PNG images in a geographic format, such as ESRI Shapefile or GeoJSON. The image must to be
         in the exact colors specified in settings.py [DL_PARAM['classes']]
@@ -61,16 +100,20 @@ class Infer:
         :param classes: the list of classes and respectively colors
         :param original_images_path: the path to the original images, certainly, with the geographic metadata
         :param output_vector_path: the output path file to save the respective geographic format
+        :param original_image: the already opened GDAL dataset of original_images_path, if any
         """
         if isinstance(segmented_image_path, list):
             for item in segmented_image_path:
-                poligonizer.Poligonize().polygonize(item, classes, original_images_path, output_vector_path)
+                poligonizer.Poligonize().polygonize(item, classes, original_images_path, output_vector_path,
+                                                    original_image)
         else:
-            poligonizer.Poligonize().polygonize(segmented_image_path, classes, original_images_path, output_vector_path)
+            poligonizer.Poligonize().polygonize(segmented_image_path, classes, original_images_path, output_vector_path,
+                                                original_image)
 
     def check_image_format(self, image_path):
         """
-        Based on file extensions, this method determines if it could be treat as a geographic format or not
+        Based on file extensions, this method determines if it could be treat as a geographic format or not. The
+        GDAL dataset opened for geographic formats is kept in the cache, to be reused by slicing and polygonization
 
         :param image_path: absolute path to the original raster image
         :return dims, is_geographic_format: the dimension size of the respective image, and a boolean,
@@ -80,20 +123,120 @@ class Infer:
 
         filename = os.path.basename(image_path)
         if filename.endswith(settings.GEOGRAPHIC_ACCEPT_EXTENSION):
-            ds = gdal.Open(image_path)
+            ds = self._gdal_cache.get(image_path)
+            if ds is None:
+                ds = gdal.Open(image_path)
             if ds is None:
                 logging.info(">>>>>> Could not open image file. Check it and try again!")
-                return
+                return None, None
+            self._gdal_cache[image_path] = ds
             dims = ds.RasterXSize, ds.RasterYSize
             is_geographic_format = True
         elif filename.endswith(settings.NON_GEOGRAPHIC_ACCEPT_EXTENSION):
-            image_full = cv2.imread(image_path)
-            dims = image_full.shape
+            with Image.open(image_path) as image:
+                width, height = image.size
+            dims = height, width, 3
         else:
             return None, None
 
         return dims, is_geographic_format
 
+    def read_image(self, image_path, network_params):
+        """
+        Read the image with OpenCV and prepare it to be presented to the deep learning model: RGB ordered and
+        resized to the network input size
+
+        :param image_path: absolute path to the image
+        :param network_params: the deep learning architecture parameters
+        :return images_array: the uint8 array with shape (input_size_h, input_size_w, channels)
+        """
+        img_width = network_params['input_size_w']
+        img_height = network_params['input_size_h']
+
+        images_array = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        images_array = cv2.cvtColor(images_array, cv2.COLOR_BGR2RGB)
+        if images_array.shape[:2] != (img_height, img_width):
+            images_array = cv2.resize(images_array, (img_width, img_height), interpolation=cv2.INTER_NEAREST)
+        return images_array
+
+    def compile_inference(self, keras_model, load_param):
+        """
+        Wrap the deep learning model in a XLA compiled function. XLA compiles one executable per input shape, so
+        only two concrete functions are built: one for batches of predict_batch_size and one for a single image,
+        which is what an image that is not sliced needs. Other batches must be padded to predict_batch_size by the
+        caller. The argmax over the classes is part of the graph, so only the uint8 classes map leaves the device.
+        Since the classes map is uint8, the model can predict at most 256 classes, and since the palette lookup of
+        the segmentation does not check bounds, every class of the model must have a color in color_classes
+
+        :param keras_model: the keras model, as returned by get_model of the deep learning architecture
+        :param load_param: a dict with the keras deep learning architecture parameters
+        :return inference: dict with the compiled function of each batch size, which receives a batch of images and
+        returns its classes maps
+        """
+        import tensorflow as tf
+
+        number_classes = keras_model.output_shape[-1]
+        if number_classes > 256:
+            raise ValueError("The model predicts {} classes, but the classes map is uint8 and holds at most 256 "
+                             "classes. Check the deep learning architecture and try again!".format(number_classes))
+        missing_classes = sorted(set(range(number_classes)) - set(load_param['color_classes']))
+        if missing_classes:
+            raise ValueError("The model predicts {} classes, but color_classes has no color for the classes {}. "
+                             "Check settings.py and try again!".format(number_classes, missing_classes))
+
+        @tf.function(jit_compile=True)
+        def inference(batch):
+            return tf.cast(tf.argmax(keras_model(batch, training=False), axis=-1), tf.uint8)
+
+        input_shape = (load_param['input_size_h'], load_param['input_size_w'], load_param['input_size_c'])
+        return {batch_size: inference.get_concrete_function(tf.TensorSpec((batch_size,) + input_shape, tf.float32))
+                for batch_size in {load_param['predict_batch_size'], 1}}
+
+    def predict_slices(self, inference, list_images, load_param, executor):
+        """
+        Build a tf.data pipeline over the slices, where reading and preprocessing run in parallel and are
+        prefetched while the deep learning model processes the previous batch. Each slice is min-max normalized
+        to [0, 255], as the training samples are. The segmentation of each batch is dispatched to the process pool,
+        so it runs while the next batch is being predicted. A single image is predicted alone, and any other last
+        batch is zero padded to predict_batch_size, as compile_inference requires. The predictions of the padding
+        are discarded
+
+        :param inference: the dict of compiled inference functions, from compile_inference
+        :param list_images: iterable of absolute paths to the slices. It might be a generator, such as the ones from
+        slicer.Slicer, so the prediction starts as soon as the first slices are cropped
+        :param load_param: a dict with the keras deep learning architecture parameters
+        :param executor: the process pool where the predictions are segmented
+        :return prediction_path_list: list of absolute paths to the segmented slices, in the same order of list_images
+        """
+        import tensorflow as tf
+
+        input_shape = (load_param['input_size_h'], load_param['input_size_w'], load_param['input_size_c'])
+
+        def load(path):
+            images_array = tf.numpy_function(lambda p: self.read_image(p.decode(), load_param), [path], tf.uint8)
+            images_array.set_shape(input_shape)
+            images_array = tf.cast(images_array, tf.float32)
+            min_value = tf.reduce_min(images_array)
+            max_value = tf.reduce_max(images_array)
+            images_array = (images_array - min_value) * tf.math.divide_no_nan(255.0, max_value - min_value)
+            return path, images_array
+
+        dataset = tf.data.Dataset.from_generator(lambda: list_images,
+                                                 output_signature=tf.TensorSpec(shape=(), dtype=tf.string))
+        dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+        batch_size = load_param['predict_batch_size']
+        dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+        segmented = []
+        for paths, batch in dataset:
+            paths = [path.decode() for path in paths.numpy()]
+            padded_size = 1 if len(paths) == 1 else batch_size
+            if len(paths) < padded_size:
+                batch = tf.pad(batch, [[0, padded_size - len(paths)], [0, 0], [0, 0], [0, 0]])
+            predictions = inference[padded_size](batch).numpy()[:len(paths)]
+            segmented.append(executor.map(_segment_one, zip(paths, predictions, repeat(load_param)), chunksize=4))
+        return list(chain.from_iterable(segmented))
+
     def predict_deep_network(self, model, load_param):
         """
         Initiate the process of inferences. The weight matrix from trained deep learning, which represents the
@@ -108,74 +251,95 @@ class Infer:
 
         path_val_images = os.path.join(load_param['image_prediction_folder'])
         pred_images = loader.Loader(path_val_images)
+        keras_model = model.get_model()
+        inference = self.compile_inference(keras_model, load_param)
 
-        for item in pred_images.get_list_images():
-            filename = os.path.basename(item)
-            name = os.path.splitext(filename)[0]
-            complete_path = os.path.join(path_val_images, item)
-            dims, is_geographic_file = self.check_image_format(complete_path)
+        futures = []
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver'), initializer=set_num_threads,
+                                 initargs=(1,)) as executor, ThreadPoolExecutor(max_workers=2) as post_exec:
+            for index, complete_path in enumerate(pred_images.get_list_images()):
+                dims, is_geographic_file = self.check_image_format(complete_path)
 
-            if dims is None or is_geographic_file is None:
-                logging.warning(">>>>>> The filename {} does not match any accepted extension. "
-                                "Check it and try again!".format(filename))
-                return
+                if dims is None or is_geographic_file is None:
+                    logging.warning(">>>>>> The filename {} does not match any accepted extension. "
+                                    "Check it and try again!".format(os.path.basename(complete_path)))
+                    break
 
-            if dims[0] > load_param['width_slice'] or dims[1] > load_param['height_slice']:
-                logging.info(">>>> Image {} is bigger than the required dimension! "
-                             "Cropping and predicting...".format(filename))
+                filename = os.path.basename(complete_path)
 
-                if is_geographic_file is True:
-                    list_images = slicer.Slicer().slice_geographic(complete_path, load_param['width_slice'],
+                tmp_folder = "{:05d}".format(index)
+                image_param = dict(load_param)
+                image_param['tmp_slices'] = os.path.join(load_param['tmp_slices'], tmp_folder)
+                image_param['tmp_slices_predictions'] = os.path.join(load_param['tmp_slices_predictions'], tmp_folder)
+                os.makedirs(image_param['tmp_slices'], exist_ok=True)
+                os.makedirs(image_param['tmp_slices_predictions'], exist_ok=True)
+
+                if dims[0] > load_param['width_slice'] or dims[1] > load_param['height_slice']:
+                    logging.info(">>>> Image {} is bigger than the required dimension! "
+                                 "Cropping and predicting...".format(filename))
+
+                    if is_geographic_file is True:
+                        list_images = slicer.Slicer().slice_geographic(complete_path, load_param['width_slice'],
+                                                                       load_param['height_slice'],
+                                                                       image_param['tmp_slices'],
+                                                                       self._gdal_cache.get(complete_path))
+                    else:
+                        list_images = slicer.Slicer().slice_bitmap(complete_path, load_param['width_slice'],
                                                                    load_param['height_slice'],
-                                                                   load_param['tmp_slices'])
+                                                                   image_param['tmp_slices'])
+
+                    logging.info(">>>> Predicting each of the slices as soon as they are cropped...")
+                    is_sliced = True
+                    prediction_path_list = self.predict_slices(inference, list_images, image_param, executor)
                 else:
-                    list_images = slicer.Slicer().slice_bitmap(complete_path, load_param['width_slice'],
-                                                               load_param['height_slice'],
-                                                               load_param['tmp_slices'])
+                    is_sliced = False
+                    prediction_path_list = self.predict_slices(inference, [complete_path], image_param, executor)
+
+                futures.append(post_exec.submit(self._finalize, complete_path, dims, is_geographic_file, is_sliced,
+                                                prediction_path_list, image_param))
 
-                logging.info(">>>> Predicting each of {} slices and predicting...".format(len(list_images)))
-                prediction_path_list = []
-                for path in list_images:
-                    images_array = load_img(path, target_size=(load_param['input_size_w'], load_param['input_size_h']))
-                    images_array = image.img_to_array(images_array)
-                    images_array = np.expand_dims(images_array, axis=0)
-                    images_array = cv2.normalize(images_array, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_32F)
+        for future in futures:
+            future.result()
 
-                    prediction = model.get_model().predict(images_array)
-                    prediction_path_list.append(self.segment_image(path, prediction, load_param))
+    def _finalize(self, complete_path, dims, is_geographic_file, is_sliced, prediction_path_list, load_param):
+        """
+        Post-process the predictions of an image: merge the predictions of its slices, or move the single
+        prediction, to the output folder, polygonize the result when it is a geographic format and remove the
+        temporary folders of the image. It runs in background, while the next image is being predicted. The
+        polygonizations are serialized, since all of them write to the same output_prediction_shp folder
+
+        :param complete_path: absolute path to the original image
+        :param dims: the dimension size of the original image, from check_image_format
+        :param is_geographic_file: a boolean, if the original image is a geographic format or not
+        :param is_sliced: a boolean, if the image was sliced or predicted as a whole
+        :param prediction_path_list: list of absolute paths to the segmented slices
+        :param load_param: a dict with the keras deep learning architecture parameters, where tmp_slices and
+        tmp_slices_predictions point to the temporary folders of this image only
+        """
+        try:
+            name = os.path.splitext(os.path.basename(complete_path))[0]
+            complete_path_to_prediction = os.path.join(load_param['output_prediction'], name + ".png")
 
+            if is_sliced is True:
                 logging.info(">>>> Merging the {} predictions in image with {} x {}...".
                              format(len(prediction_path_list), dims[0], dims[1]))
-                complete_path_to_merged_prediction = os.path.join(load_param['output_prediction'], name + ".png")
-                slicer.Slicer().merge_images(prediction_path_list, dims[0], dims[1],
-                                             complete_path_to_merged_prediction)
-
-                if is_geographic_file is True:
-                    logging.info(">>>> Polygonizing segmented image...")
-                    self.poligonize(complete_path_to_merged_prediction,
-                                    load_param['classes'],
-                                    complete_path,
-                                    load_param['output_prediction_shp'])
+                slicer.Slicer().merge_images(prediction_path_list, dims[0], dims[1], complete_path_to_prediction)
             else:
-                image_to_predict = load_img(complete_path, target_size=(load_param['input_size_w'],
-                                                                        load_param['input_size_h']))
-                images_array = image.img_to_array(image_to_predict)
-                images_array = cv2.normalize(images_array, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_32F)
-                images_array = np.expand_dims(images_array, axis=0)
-
-                prediction = model.get_model().predict(images_array)
+                os.replace(prediction_path_list[0], complete_path_to_prediction)
 
-                prediction_path = self.segment_image(complete_path, prediction, load_param)
-
-                complete_path_to_prediction = os.path.join(load_param['output_prediction'], name + ".png")
-                os.replace(prediction_path, complete_path_to_prediction)
-
-                if is_geographic_file is True:
-                    logging.info(">>>> Polygonizing segmented image...")
+            if is_geographic_file is True:
+                logging.info(">>>> Polygonizing segmented image...")
+                with self._poligonize_lock:
                     self.poligonize(complete_path_to_prediction,
                                     load_param['classes'],
                                     complete_path,
-                                    load_param['output_prediction_shp'])
-
-            utils.Utils().flush_files(load_param['tmp_slices'])
-            utils.Utils().flush_files(load_param['tmp_slices_predictions'])
+                                    load_param['output_prediction_shp'],
+                                    self._gdal_cache.get(complete_path))
+        except Exception:
+            logging.exception(">>>>>> Something went wrong post-processing {}...".format(complete_path))
+            raise
+        finally:
+            self._gdal_cache.pop(complete_path, None)
+            for folder in (load_param['tmp_slices'], load_param['tmp_slices_predictions']):
+                utils.Utils().flush_files(folder)
+                os.rmdir(folder)
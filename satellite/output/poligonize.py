@@ -120,7 +120,7 @@ class Poligonize:
         return image_segmented
 
     def create_shapefile(self, segmented_image_path, classes, original_image_path, output_vector_path,
-                         vector_type='ESRI Shapefile'):
+                         vector_type='ESRI Shapefile', original_image=None):
         """
         Perform operations to read original image [remote sensing data], and from its metadata, create a new vector
         file according to the classes specified in settings.py file
@@ -132,13 +132,17 @@ class Poligonize:
                                     read and transfer to the output
         :param output_vector_path: the output path, where the new geographic format is saved
         :param vector_type: default value is ESRI Shapefile (most common), but GeoJSON is accepted
+        :param original_image: the GDAL dataset of original_image_path, if it is already opened. Otherwise,
+                               original_image_path is opened
         """
         logging.info(">>>>>> Creating vector file...")
 
         filename = basename(original_image_path)
         name = os.path.splitext(filename)[0]
 
-        image = gdal.Open(original_image_path)
+        image = original_image
+        if image is None:
+            image = gdal.Open(original_image_path)
 
         driver = ogr.GetDriverByName(vector_type)
         ds = driver.CreateDataSource(output_vector_path)
@@ -193,7 +197,7 @@ class Poligonize:
         else:
             logging.info(">>>>>> Name {} was not recognized. Layer None!".format(name))
 
-    def polygonize(self, segmented_image_path, classes, original_image_path, output_vector_path):
+    def polygonize(self, segmented_image_path, classes, original_image_path, output_vector_path, original_image=None):
         """
         Turn a JPG, PNG images in a geographic format, such as ESRI Shapefile or GeoJSON. The image must to be
         in the exact colors specified in settings.py - DL_PARAM['classes']
@@ -202,6 +206,7 @@ class Poligonize:
         :param classes: the list of classes and respectively colors
         :param original_image_path: the original raster image path, where the geographic metadata is read and transfer to the output
         :param output_vector_path: the output path, where the new geographic format is saved
+        :param original_image: the GDAL dataset of original_image_path, if it is already opened
         """
         logging.info(">>>> Initiating polygonization of the raster result...")
 
@@ -209,5 +214,6 @@ class Poligonize:
             logging.info(">>>>>> There is no corresponding PNG image for {}!".format(original_image_path))
             return
 
-        self.create_shapefile(segmented_image_path, classes, original_image_path, output_vector_path, 'ESRI Shapefile')
+        self.create_shapefile(segmented_image_path, classes, original_image_path, output_vector_path, 'ESRI Shapefile',
+                              original_image)
 
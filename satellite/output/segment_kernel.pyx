@@ -0,0 +1,22 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+
+
+def palette_lookup(const unsigned char[:, ::1] classes_map, const unsigned char[:, ::1] palette,
+                   unsigned char[:, :, ::1] out):
+    """
+    Native counterpart of satellite.output._kernels.palette_lookup_numba, compiled with -O3 -march=native. It runs
+    serially, since the segmentations are already spread over the process pool. See there for the parameters
+    """
+    cdef Py_ssize_t H = classes_map.shape[0]
+    cdef Py_ssize_t W = classes_map.shape[1]
+    cdef Py_ssize_t i, j
+    cdef unsigned char best
+
+    with nogil:
+        for i in range(H):
+            for j in range(W):
+                best = classes_map[i, j]
+                out[i, j, 0] = palette[best, 0]
+                out[i, j, 1] = palette[best, 1]
+                out[i, j, 2] = palette[best, 2]
+                out[i, j, 3] = palette[best, 3]
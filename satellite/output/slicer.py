@@ -22,7 +22,7 @@ class Slicer:
         :param width: the desired tile width
         :param height: the desired tile height
         :param output_folder: the destination folder of the tiles/slices
-        :return paths: a list of absolute paths, regarding each tile cropped
+        :return: yields the absolute path of each tile, as soon as it is cropped
         """
         logging.info(">>>> Slicing image " + file + "...")
 
@@ -37,7 +37,6 @@ class Slicer:
         cols, rows = image.size
 
         cont = 0
-        paths = []
         buffer = settings.BUFFER_TO_INFERENCE
         for j in range(0, cols, (height - buffer)):
             for i in range(0, rows, (width - buffer)):
@@ -45,11 +44,10 @@ class Slicer:
                 if not ((i + width) > rows) and not ((j + height) > cols):
                     image.crop((i, j, i + width, j + height)).save(output_file)
 
-                    paths.append(output_file)
                     cont += 1
-        return paths
+                    yield output_file
 
-    def slice_geographic(self, file, width, height, output_folder):
+    def slice_geographic(self, file, width, height, output_folder, ds=None):
         """
         Open the image file, and crop it equally with dimensions of width x height, placing it in output_folder.
         The remaining borders is also cropped and saved in the folder
@@ -58,7 +56,8 @@ class Slicer:
         :param width: the desired tile width
         :param height: the desired tile height
         :param output_folder: the destination folder of the tiles/slices
-        :return paths: a list of absolute paths, regarding each tile cropped
+        :param ds: the GDAL dataset of file, if it is already opened. Otherwise, file is opened
+        :return: yields the absolute path of each tile, as soon as it is cropped
         """
         logging.info(">>>> Slicing image " + file + "...")
 
@@ -69,7 +68,8 @@ class Slicer:
             logging.info(">>>>>> Image {} does not exist. Check it and try again!".format(filename))
             return
 
-        ds = gdal.Open(file)
+        if ds is None:
+            ds = gdal.Open(file)
         if ds is None:
             logging.info(">>>>>> Could not open image file. Check it and try again!")
             return
@@ -79,7 +79,6 @@ class Slicer:
         cols = ds.RasterYSize
         datatype = ds.GetRasterBand(1).DataType
 
-        paths = []
         gdal.UseExceptions()
         buffer = settings.BUFFER_TO_INFERENCE
         for j in range(0, cols, (height - buffer)):
@@ -93,11 +92,10 @@ class Slicer:
                                                                      '-b', settings.RASTER_TILES_COMPOSITION[1],
                                                                      '-b', settings.RASTER_TILES_COMPOSITION[2]])
 
-                        paths.append(output_file)
                         cont += 1
+                        yield output_file
                 except RuntimeError:
                     logging.warning(">>>>>> Something went wrong during image slicing...")
-        return paths
 
     def merge_images(self, paths, max_width, max_height, complete_path_to_merged_prediction):
         """
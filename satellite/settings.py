@@ -32,6 +32,7 @@ DL_PARAM = {
         'input_size_h': 256,
         'input_size_c': 3,
         'batch_size': 16,
+        'predict_batch_size': 16,
         'learning_rate': 0.0001,
         'filters': 32,
         'kernel_size': 3,
@@ -65,6 +66,7 @@ DL_PARAM = {
         'input_size_h': 256,
         'input_size_c': 3,
         'batch_size': 16,
+        'predict_batch_size': 16,
         'learning_rate': 0.001,
         'filters': 32,
         'kernel_size': 3,
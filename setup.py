@@ -1,9 +1,17 @@
-from setuptools import setup
+from setuptools import setup, Extension
+
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('satellite.output.segment_kernel', ['satellite/output/segment_kernel.pyx'],
+                                       extra_compile_args=['-O3', '-march=native'])])
+except ImportError:
+    ext_modules = []
 
 setup(
     name='deep-learning',
     version='1.0',
     packages=[''],
+    ext_modules=ext_modules,
     url='https://bioverse-dl.readthedocs.io/en/latest/',
     license='MIT ',
     author='rodolfo.lotte',